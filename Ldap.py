@@ -1,18 +1,88 @@
-from ldap3 import Connection, Server
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from ldap3 import AUTO_BIND_NO_TLS, AUTO_BIND_TLS_BEFORE_BIND, Connection, Server, Tls
+from ldap3.core.exceptions import LDAPInvalidDnError
+from ldap3.utils.conv import escape_filter_chars
+from ldap3.utils.dn import parse_dn
 import logging
+import queue
+import re
+import socket
+import ssl
+
+# LDAP_MATCHING_RULE_IN_CHAIN, walks nested group membership server side
+MATCHING_RULE_IN_CHAIN = '1.2.840.113556.1.4.1941'
+
+
+def base_dn(dn):
+    """
+    Return the domain component suffix of a DN
+    """
+    return ','.join(rdn.strip() for rdn in dn.split(',') if rdn.strip().upper().startswith('DC='))
+
+
+def normalize_dn(dn):
+    """
+    Return a DN in a comparable form, ignoring case, spaces around separators and escaping style
+    """
+    try:
+        rdns = parse_dn(dn, strip=True)
+    except LDAPInvalidDnError:
+        return dn.lower()
+
+    return tuple(
+        (attribute.lower(), unescape_dn_value(value).lower(), separator)
+        for attribute, value, separator in rdns
+    )
+
+
+def unescape_dn_value(value):
+    """
+    Decode the backslash escapes and hex pairs of a DN attribute value
+    """
+    return re.sub(
+        rb'\\([0-9A-Fa-f]{2}|.)',
+        lambda match: bytes.fromhex(match.group(1).decode()) if len(match.group(1)) == 2 else match.group(1),
+        value.encode(),
+        flags=re.DOTALL
+    ).decode(errors='replace')
+
+
+def search_entries(response):
+    """
+    Yield the entries of a search response, skipping search references
+    """
+    return (entry for entry in response if entry['type'] == 'searchResEntry')
 
 
 class LDAP(object):
     """
     LDAP connection class
     """
+    server = None
     connection = None
+    pool = None
+    bindUser = None
+    bindPassword = None
+    receiveTimeout = None
+    startTls = False
     objectGroup = None
     objectUser = None
     attributeMember = None
     attributeLastName = None
     attributeFirstName = None
     attributeUsername = None
+    attributeDn = None
+    filterGroup = None
+    filterUser = None
+    filterRecursive = None
+    attributesUser = None
+    baseDn = None
+    batchSize = None
+    recursive = False
+    pageSize = None
+    poolSize = None
+    userCache = None
 
     def __init__(
             self,
@@ -24,19 +94,34 @@ class LDAP(object):
             attribute_member=None,
             attribute_last_name=None,
             attribute_first_name=None,
-            attribute_username=None
+            attribute_username=None,
+            attribute_dn=None,
+            base_dn=None,
+            batch_size=None,
+            recursive=False,
+            page_size=None,
+            pool_size=None,
+            connect_timeout=None,
+            receive_timeout=None,
+            start_tls=False,
+            validate_certificate=False
     ):
-        server = Server(
-            uri
+        self.server = Server(
+            uri,
+            connect_timeout=connect_timeout or 10,
+            tls=Tls(validate=ssl.CERT_REQUIRED if validate_certificate else ssl.CERT_NONE)
         )
 
-        self.connection = Connection(
-            server,
-            user=bind_user,
-            password=bind_password,
-            auto_bind=True,
-            auto_referrals=False
-        )
+        self.bindUser = bind_user
+        self.bindPassword = bind_password
+        self.receiveTimeout = receive_timeout
+        self.startTls = start_tls
+
+        self.connection = self.connect()
+
+        # bound connections for concurrent searches, created on demand
+        self.pool = queue.Queue()
+        self.pool.put(self.connection)
 
         self.objectGroup = object_group or 'group'
         self.objectUser = object_user or 'user'
@@ -44,50 +129,288 @@ class LDAP(object):
         self.attributeLastName = attribute_last_name or 'sn'
         self.attributeFirstName = attribute_first_name or 'givenName'
         self.attributeUsername = attribute_username or 'sAMAccountName'
+        self.attributeDn = attribute_dn or 'distinguishedName'
+        self.baseDn = base_dn
+        self.batchSize = batch_size or 500
+        self.recursive = recursive
+        self.pageSize = page_size or 1000
+        self.poolSize = pool_size or 8
 
-    def get_group(self, group_dn):
-        self.connection.search(
-            search_base=group_dn,
-            search_filter=f"(objectClass={self.objectGroup})",
-            search_scope='SUBTREE',
-            attributes=['cn', self.attributeMember]
+        # search filters and attributes only depend on the configuration
+        self.filterGroup = f"(objectClass={escape_filter_chars(self.objectGroup)})"
+        self.filterUser = f"(objectClass={escape_filter_chars(self.objectUser)})"
+        self.filterRecursive = f"(&{self.filterUser}(memberOf:{MATCHING_RULE_IN_CHAIN}:=%s))"
+        self.attributesUser = [
+            self.attributeLastName,
+            self.attributeFirstName,
+            self.attributeUsername
+        ]
+
+        # user attributes by normalized DN, kept until close()
+        self.userCache = {}
+
+    def connect(self):
+        connection = Connection(
+            self.server,
+            user=self.bindUser,
+            password=self.bindPassword,
+            auto_bind=AUTO_BIND_TLS_BEFORE_BIND if self.startTls else AUTO_BIND_NO_TLS,
+            auto_referrals=False,
+            version=3,
+            receive_timeout=self.receiveTimeout
         )
 
-        response = self.connection.response
+        # let the kernel detect dead peers during long searches
+        if connection.socket:
+            connection.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                connection.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60)
+                connection.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+                connection.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+
+        return connection
+
+    @contextmanager
+    def pooled_connection(self):
+        """
+        Check out a bound connection from the pool, binding a new one if none is idle
+        """
+        try:
+            connection = self.pool.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+
+        try:
+            yield connection
+        finally:
+            self.pool.put(connection)
+
+    def close(self):
+        """
+        Unbind all pooled connections and drop cached users.
+        """
+        while not self.pool.empty():
+            self.pool.get_nowait().unbind()
+
+        self.userCache.clear()
+
+    def get_group(self, group_dn):
+        with self.pooled_connection() as connection:
+            connection.search(
+                search_base=group_dn,
+                search_filter=self.filterGroup,
+                search_scope='BASE',
+                attributes=[self.attributeMember]
+            )
+
+            response = list(search_entries(connection.response))
 
         if len(response) > 1:
             raise Exception("Multiple groups found.")
 
         if len(response) == 0:
-            logging.warning(f"Group '{group_dn}' not found.")
+            logging.warning("Group '%s' not found.", group_dn)
             return False
 
         return response[0]['attributes']
 
     def get_group_member(self, group_dn):
-
         group = self.get_group(group_dn)
 
         if not group:
             return []
 
-        return group['member']
+        return group[self.attributeMember]
 
-    def get_user(self, user_dn):
-        self.connection.search(
-            search_base=user_dn,
-            search_filter=f"(objectClass={self.objectUser})",
-            search_scope='SUBTREE',
-            attributes=[
-                self.attributeLastName,
-                self.attributeFirstName,
-                self.attributeUsername
-            ]
-        )
+    def get_group_users(self, group_dn):
+        """
+        Resolve the users of a group including nested groups
+        """
+        with self.pooled_connection() as connection:
+            return dict(self.search_users(
+                self.baseDn or base_dn(group_dn),
+                self.filterRecursive % escape_filter_chars(group_dn),
+                connection
+            ))
+
+    def get_groups_users(self, group_dns):
+        """
+        Resolve the users of several groups, searching the members of all groups together
+        """
+        if self.recursive:
+            groups = {}
 
-        response = self.connection.response
+            # search a group configured more than once only once
+            for group_dn in group_dns:
+                if normalize_dn(group_dn) not in groups:
+                    groups[normalize_dn(group_dn)] = self.get_group_users(group_dn)
+
+            return {group_dn: groups[normalize_dn(group_dn)] for group_dn in group_dns}
+
+        members = {}
+        pending = {}
+        queued = set()
+
+        with ThreadPoolExecutor(max_workers=self.poolSize) as executor:
+            searches = []
+
+            for group_dn, member_dns in self.iter_groups_member(group_dns):
+
+                # normalize each member DN once, the key is reused for the batches and the result
+                member_keys = [(normalize_dn(dn), dn) for dn in member_dns]
+                members[normalize_dn(group_dn)] = member_keys
+
+                # queue each member only once across all groups, batched by its search base
+                for key, dn in member_keys:
+                    if key not in queued and key not in self.userCache:
+                        queued.add(key)
+
+                        search_base = self.search_base(dn)
+                        pending.setdefault(search_base, []).append((key, dn))
+
+                        # search full batches while the remaining groups are still read
+                        if len(pending[search_base]) >= self.batchSize:
+                            searches.append(executor.submit(self.get_user_batch, search_base, pending.pop(search_base)))
+
+            for search_base, batch in pending.items():
+                searches.append(executor.submit(self.get_user_batch, search_base, batch))
+
+            # fill the user cache, raising any search error
+            for search in searches:
+                search.result()
+
+        # members that are no users, like nested groups, are left out
+        return {
+            group_dn: {
+                dn: self.userCache[key]
+                for key, dn in members.get(normalize_dn(group_dn), [])
+                if key in self.userCache
+            }
+            for group_dn in group_dns
+        }
+
+    def iter_groups_member(self, group_dns):
+        """
+        Yield (configured group dn, member DNs) per group, reading all groups
+        with one OR-ed equality search per batch and search base
+        """
+        missing = {normalize_dn(group_dn): group_dn for group_dn in group_dns}
+
+        with self.pooled_connection() as connection:
+            for search_base, batch in self.batches(list(missing.values())):
+
+                # without a search base the groups are read one by one below
+                if not search_base:
+                    continue
+
+                dn_filter = ''.join(f"({self.attributeDn}={escape_filter_chars(dn)})" for dn in batch)
+
+                entries = connection.extend.standard.paged_search(
+                    search_base=search_base,
+                    search_filter=f"(&{self.filterGroup}(|{dn_filter}))",
+                    search_scope='SUBTREE',
+                    attributes=[self.attributeMember],
+                    paged_size=self.pageSize,
+                    generator=True
+                )
+
+                # match the returned DN to the configured one, which may be written differently
+                for entry in search_entries(entries):
+                    group_dn = missing.pop(normalize_dn(entry['dn']), None)
+
+                    if group_dn is not None:
+                        yield group_dn, entry['attributes'][self.attributeMember]
+
+        # groups the search did not return are read by DN, which warns if they do not exist
+        for group_dn in missing.values():
+            yield group_dn, self.get_group_member(group_dn)
+
+    def get_user(self, user_dn, key=None):
+        """
+        Read a user by DN, returns None if the DN is no user
+        """
+        key = key or normalize_dn(user_dn)
+
+        # check in cache for user
+        if key in self.userCache:
+            return self.userCache[key]
+
+        with self.pooled_connection() as connection:
+            connection.search(
+                search_base=user_dn,
+                search_filter=self.filterUser,
+                search_scope='BASE',
+                attributes=self.attributesUser
+            )
+
+            response = list(search_entries(connection.response))
 
         if len(response) > 1:
             raise Exception("Multiple users found.")
 
+        if len(response) == 0:
+            return None
+
+        self.userCache[key] = response[0]['attributes']
+
         return response[0]['attributes']
+
+    def search_base(self, dn):
+        return self.baseDn or base_dn(dn)
+
+    def batches(self, dns):
+        """
+        Yield (search base, DNs) batches of at most batchSize DNs sharing a search base
+        """
+        bases = {}
+
+        for dn in dns:
+            bases.setdefault(self.search_base(dn), []).append(dn)
+
+        for search_base, base_dns in bases.items():
+            for i in range(0, len(base_dns), self.batchSize):
+                yield search_base, base_dns[i:i + self.batchSize]
+
+    def get_user_batch(self, search_base, batch):
+        """
+        Search a batch of (normalized DN, DN) pairs with one OR-filtered search,
+        reading the DNs it did not return one by one
+        """
+        if search_base:
+            dn_filter = ''.join(f"({self.attributeDn}={escape_filter_chars(dn)})" for key, dn in batch)
+
+            # the search fills the user cache
+            with self.pooled_connection() as connection:
+                for _ in self.search_users(search_base, f"(&{self.filterUser}(|{dn_filter}))", connection):
+                    pass
+
+        # members that are no users, like nested groups, are expected to be missing
+        users = [dn for key, dn in batch if key not in self.userCache and self.get_user(dn, key)]
+
+        if users and search_base:
+            logging.warning(
+                "%s users were not found by %s under %s and were read one by one. "
+                "Check the ldap attributeDn setting, OpenLDAP uses entryDN.",
+                len(users),
+                self.attributeDn,
+                search_base
+            )
+
+    def search_users(self, search_base, search_filter, connection):
+        """
+        Page through a user search, yielding (dn, attributes) per entry
+        """
+        entries = connection.extend.standard.paged_search(
+            search_base=search_base,
+            search_filter=search_filter,
+            search_scope='SUBTREE',
+            attributes=self.attributesUser,
+            paged_size=self.pageSize,
+            generator=True
+        )
+
+        for entry in search_entries(entries):
+            self.userCache[normalize_dn(entry['dn'])] = entry['attributes']
+
+            yield entry['dn'], entry['attributes']
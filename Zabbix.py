@@ -1,27 +1,50 @@
 from deepdiff import DeepDiff
 import logging
 from pyzabbix import ZabbixAPI
+from requests import Session
+from requests.adapters import HTTPAdapter
+import semantic_version
 
 
-def resolve_permission(name):
-    if name == 'denied':
-        return '0'
+# Zabbix host group permission ids by name
+PERMISSIONS = {
+    'denied': '0',
+    'read': '2',
+    'read-write': '3'
+}
 
-    if name == 'read':
-        return '2'
 
-    if name == 'read-write':
-        return '3'
+def resolve_permission(name):
+    if name in PERMISSIONS:
+        return PERMISSIONS[name]
 
-    logging.error(f"Permission {name} not found.")
-    logging.error("Possible permissions: 'denied', 'ready', 'read-write'.")
+    logging.error("Permission %s not found.", name)
+    logging.error("Possible permissions: 'denied', 'read', 'read-write'.")
     raise Exception(f"Permission {name} not found.")
 
 
+def user_changed(z_user, user):
+    """
+    Compare the synced fields of a Zabbix user, ignoring the order of user groups.
+    """
+    for key, value in user.items():
+
+        if key == 'usrgrps':
+            if {g['usrgrpid'] for g in value} != {g['usrgrpid'] for g in z_user.get('usrgrps', [])}:
+                return True
+
+        elif z_user.get(key) != value:
+            return True
+
+    return False
+
+
 class Zabbix:
     zapi = None
-    hostGroups = {}
-    roles = {}
+    hostGroups = None
+    roles = None
+    users = None
+    userGroups = None
     token = False
 
     def __init__(
@@ -31,37 +54,70 @@ class Zabbix:
             password,
             api_token=None
     ):
-        self.zapi = ZabbixAPI(url)
+        # per instance caches, class level dicts would be shared between instances
+        self.hostGroups = {}
+        self.roles = {}
+
+        # pyzabbix keeps its session alive already, mount an adapter to retry failed connections
+        session = Session()
+        adapter = HTTPAdapter(max_retries=3)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        # pyzabbix requests the version twice when detecting it, request it once
+        self.zapi = ZabbixAPI(url, session=session, detect_version=False)
+        self.zapi.version = semantic_version.Version(self.zapi.api_version())
         self.zapi.login(user, password, api_token=api_token)
 
         if api_token:
             self.token = True
 
-    def get_host_group(self, name):
+    def get_host_groups(self, names):
+        """
+        Resolve host group ids by name, requesting all uncached names at once.
+        """
+        missing = [name for name in set(names) if name not in self.hostGroups]
+
+        if missing:
+            # resolve the Zabbix host groups
+            response = self.zapi.hostgroup.get(
+                output=['groupid', 'name'],
+                filter={
+                    'name': missing
+                }
+            )
 
-        # check in cache for host group id
-        if name in self.hostGroups:
-            return self.hostGroups[name]
+            for hostgroup in response:
+                self.hostGroups[hostgroup['name']] = hostgroup['groupid']
 
-        # resolve the Zabbix host group
-        response = self.zapi.hostgroup.get(
-            output=['groupid'],
-            filter={
-                'name': name
-            }
-        )
+            # remember missing host groups as well
+            for name in missing:
+                if name not in self.hostGroups:
+                    logging.info("No hostgroup found for %s.", name)
+                    self.hostGroups[name] = False
 
-        if len(response) > 1:
-            logging.error("Multiple Zabbix users found with same username.")
-            raise Exception("Multiple Zabbix users found.")
+        return {name: self.hostGroups[name] for name in names}
 
-        if len(response) == 0:
-            logging.info(f"No hostgroup found for {name}.")
-            return False
+    def get_user_groups(self):
+        """
+        Get all Zabbix user groups by name, fetched once per sync.
+        """
 
-        return response[0]['groupid']
+        # check if already fetched
+        if self.userGroups is not None:
+            return self.userGroups
 
-    def group_update_or_create(self, name, hostgroups=None, enabled=True):
+        response = self.zapi.usergroup.get(
+            output=['name', 'gui_access', 'users_status'],
+            selectRights='extend',
+            selectTagFilters='extend'
+        )
+
+        self.userGroups = {z_group['name']: z_group for z_group in response}
+
+        return self.userGroups
+
+    def build_user_group(self, name, hostgroups=None, enabled=True):
 
         if hostgroups is None:
             hostgroups = []
@@ -74,9 +130,11 @@ class Zabbix:
             'tag_filters': []
         }
 
+        z_group_ids = self.get_host_groups([hostgroup['group'] for hostgroup in hostgroups])
+
         for hostgroup in hostgroups:
 
-            z_group_id = self.get_host_group(hostgroup['group'])
+            z_group_id = z_group_ids[hostgroup['group']]
 
             # only proceed if group exists
             if z_group_id:
@@ -98,124 +156,157 @@ class Zabbix:
                             'value': tag['value']
                         })
 
-        response = self.zapi.usergroup.get(
-            output=['name', 'gui_access', 'users_status'],
-            filter={
-                'name': name
-            },
-            selectRights='extend',
-            selectTagFilters='extend'
-        )
+        return group
+
+    def group_update_or_create(self, name, hostgroups=None, enabled=True):
+        return self.groups_update_or_create([self.build_user_group(name, hostgroups, enabled)])[name]
 
-        if len(response) > 1:
-            logging.error("Multiple Zabbix users found with same username.")
-            raise Exception("Multiple Zabbix users found.")
+    def groups_update_or_create(self, groups):
+        """
+        Create and update user groups with one request each, returns the group ids by name.
+        """
+        z_groups = self.get_user_groups()
 
-        if len(response) == 0:
-            # create user group
-            return self.zapi.usergroup.create(
-                **group
-            )['usrgrpids'][0]
+        create = {}
+        update = {}
 
-        # diff group
-        z_group_data = response[0]
+        for group in groups:
+            name = group['name']
 
-        # remove id from data
-        z_group_id = z_group_data.pop('usrgrpid')
+            # a group configured twice is created or updated once with its last definition
+            if name not in z_groups:
+                logging.info("Creating new group %s", name)
+                create[name] = group
+                continue
 
-        diff = DeepDiff(
-            z_group_data,
-            group,
-            ignore_order=True
-        )
+            # diff group
+            z_group_data = z_groups[name]
 
-        # check if update required
-        if diff:
-            logging.info(f"Updating group {name} with id {z_group_id}.")
+            z_group_id = z_group_data['usrgrpid']
 
-            # update group
-            self.zapi.usergroup.update(
-                usrgrpid=z_group_id,
-                **group
+            # ignore id in diff without altering the response
+            diff = DeepDiff(
+                z_group_data,
+                group,
+                ignore_order=True,
+                exclude_paths=["root['usrgrpid']"]
             )
 
-        return z_group_id
+            # check if update required
+            if diff:
+                logging.info("Updating group %s with id %s.", name, z_group_id)
+                update[name] = dict(group, usrgrpid=z_group_id)
+
+        if update:
+            self.zapi.usergroup.update(*update.values())
+
+        if create:
+            # create user groups
+            z_group_ids = self.zapi.usergroup.create(*create.values())['usrgrpids']
+
+            for group, z_group_id in zip(create.values(), z_group_ids):
+                update[group['name']] = dict(group, usrgrpid=z_group_id)
+
+        # keep cache in sync
+        z_groups.update(update)
+
+        return {group['name']: z_groups[group['name']]['usrgrpid'] for group in groups}
 
     def get_role_id(self, name):
+        return self.get_role_ids([name])[name]
 
-        # check if already resolved
-        if name in self.roles:
-            return self.roles[name]
+    def get_role_ids(self, names):
+        """
+        Resolve role ids by name, requesting all unresolved names at once.
+        """
+        missing = [name for name in set(names) if name not in self.roles]
+
+        if missing:
+            response = self.zapi.role.get(
+                output=['roleid', 'name'],
+                filter={
+                    'name': missing
+                }
+            )
 
-        response = self.zapi.role.get(
-            output=['roleid'],
-            filter={
-                'name': name
-            }
-        )
+            for role in response:
+                self.roles[role['name']] = role['roleid']
 
-        if len(response) > 1:
-            logging.error("Multiple Zabbix roles found with same alias.")
-            raise Exception("Multiple Zabbix roles found.")
+            for name in missing:
+                if name not in self.roles:
+                    logging.error("Zabbix role %s not found.", name)
+                    raise Exception(f"Zabbix role {name} not found.")
 
-        role_id = response[0]['roleid']
+        return {name: self.roles[name] for name in names}
 
-        self.roles[name] = role_id
+    def get_users(self):
+        """
+        Get all Zabbix users by username, fetched once per sync.
+        """
 
-        return role_id
+        # check if already fetched
+        if self.users is not None:
+            return self.users
 
-    def user_update_or_create(
-            self,
-            user
-    ):
+        # get access flags as well to find LDAP users without another request
         response = self.zapi.user.get(
             output=['userid', 'username', 'name', 'surname', 'roleid'],
             selectUsrgrps=['usrgrpid'],
-            filter={
-                'username': user['username']
-            }
+            getAccess=True
         )
 
-        if len(response) > 1:
-            logging.error("Multiple Zabbix users found with same username.")
-            raise Exception("Multiple Zabbix users found.")
+        self.users = {z_user['username']: z_user for z_user in response}
 
-        if len(response) == 0:
-            # create new user
-            logging.info(f"Creating new User {user['username']}")
+        return self.users
 
-            return self.zapi.user.create(
-                **user
-            )['userids'][0]
+    def users_update_or_create(
+            self,
+            users
+    ):
+        """
+        Create and update users with one API request each, returns the user ids by username.
+        """
+        z_users = self.get_users()
 
-        # Diff old user
-        z_user_data = response[0]
-        z_user_id = z_user_data.pop('userid')
+        create = []
+        update = []
 
-        diff = DeepDiff(
-            z_user_data,
-            user,
-            ignore_order=True
-        )
+        for user in users:
+            z_user_data = z_users.get(user['username'])
 
-        # update Zabbix user
-        if diff:
-            logging.info(f"Updating user {user['username']} with id {z_user_id}.")
-            self.zapi.user.update(
-                userid=z_user_id,
-                **user
-            )
+            if z_user_data is None:
+                logging.info("Creating new User %s", user['username'])
+                create.append(user)
+                continue
+
+            z_user_id = z_user_data['userid']
+
+            # update Zabbix user
+            if user_changed(z_user_data, user):
+                logging.info("Updating user %s with id %s.", user['username'], z_user_id)
+                update.append(dict(user, userid=z_user_id))
+
+        if update:
+            self.zapi.user.update(*update)
 
-        return z_user_id
+        if create:
+            z_user_ids = self.zapi.user.create(*create)['userids']
+
+            update += [dict(user, userid=z_user_id) for user, z_user_id in zip(create, z_user_ids)]
+
+        # keep cache in sync
+        for user in update:
+            z_users[user['username']] = dict(z_users.get(user['username'], {}), **user)
+
+        return {user['username']: z_users[user['username']]['userid'] for user in users}
 
     def get_ldap_user_groups(self):
-        return self.zapi.usergroup.get(
-            output='extend',
-            filter={
-                'gui_access': 2,
-                'users_status': 0
-            }
-        )
+
+        # filter enabled ldap groups from the cached user groups
+        return [
+            z_group for z_group in self.get_user_groups().values()
+            if z_group['gui_access'] == '2' and z_group['users_status'] == '0'
+        ]
 
     def delete_user_group(self, groups):
 
@@ -223,19 +314,13 @@ class Zabbix:
         if not groups:
             return
 
-        logging.info(f"Deleting Zabbix groups ({', '.join(groups)}).")
+        logging.info("Deleting Zabbix groups (%s).", ', '.join(groups))
         self.zapi.do_request('usergroup.delete', params=groups)
 
     def get_ldap_users(self):
 
-        # get all users because we cannot filter by gui_access flag.
-        z_users = self.zapi.user.get(
-            output=['userid', 'username'],
-            getAccess=True
-        )
-
-        # filter ldap users
-        return [z_user for z_user in z_users if z_user['gui_access'] == "2"]
+        # filter ldap users from the cached users because we cannot filter by gui_access flag.
+        return [z_user for z_user in self.get_users().values() if z_user.get('gui_access') == "2"]
 
     def delete_users(self, users):
 
@@ -243,24 +328,20 @@ class Zabbix:
         if not users:
             return
 
-        logging.info(f"Deleting Zabbix users ({', '.join(users)}).")
+        logging.info("Deleting Zabbix users (%s).", ', '.join(users))
         self.zapi.do_request('user.delete', params=users)
 
     def disable_users(self, users, disabled_group_id):
 
-        # get old users of this group
-        old_users = self.zapi.usergroup.get(
-            output=['usrgrpid'],
-            selectUsers=['userid'],
-            usrgrpids=[disabled_group_id]
-        )
-
-        if old_users:
-
-            old_user_ids = list(map(lambda u: u['userid'], old_users[0]['users']))
+        # get old users of this group from the cached user groups
+        old_user_ids = {
+            z_user['userid']
+            for z_user in self.get_users().values()
+            if {'usrgrpid': disabled_group_id} in z_user.get('usrgrps', [])
+        }
 
-            # merge users with old users
-            users += list(set(old_user_ids) - set(users))
+        # merge users with old users
+        users += list(old_user_ids.difference(users))
 
         # update group with userids
         self.zapi.usergroup.update(
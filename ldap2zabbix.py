@@ -1,4 +1,5 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from Ldap import LDAP
 import logging
 import yaml
@@ -57,6 +58,7 @@ if __name__ == '__main__':
 
     zabbixDefaultRole = config['zabbix']['default-role']
     zabbixDisabledGroup = config['zabbix'].get('disabled-group', 'Disabled-LDAP-Users')
+    zabbixLogLevel = config['zabbix'].get('log-level') or 'INFO'
 
     # LDAP configuration
     ldapUri = config['ldap']['uri']
@@ -68,6 +70,16 @@ if __name__ == '__main__':
     ldapAttributeLastName = config['ldap'].get('attributeLastName')
     ldapAttributeFirstName = config['ldap'].get('attributeFirstName')
     ldapAttributeUsername = config['ldap'].get('attributeUsername')
+    ldapAttributeDn = config['ldap'].get('attributeDn')
+    ldapBaseDn = config['ldap'].get('baseDn')
+    ldapBatchSize = config['ldap'].get('batchSize')
+    ldapRecursive = config['ldap'].get('recursive', False)
+    ldapPageSize = config['ldap'].get('pageSize')
+    ldapPoolSize = config['ldap'].get('poolSize')
+    ldapConnectTimeout = config['ldap'].get('connectTimeout')
+    ldapReceiveTimeout = config['ldap'].get('receiveTimeout')
+    ldapStartTls = config['ldap'].get('startTls', False)
+    ldapValidateCertificate = config['ldap'].get('validateCertificate', False)
 
     # sync configuration
     syncGroups = config['groups']
@@ -82,9 +94,23 @@ if __name__ == '__main__':
         attribute_member=ldapAttributeMember,
         attribute_last_name=ldapAttributeLastName,
         attribute_first_name=ldapAttributeFirstName,
-        attribute_username=ldapAttributeUsername
+        attribute_username=ldapAttributeUsername,
+        attribute_dn=ldapAttributeDn,
+        base_dn=ldapBaseDn,
+        batch_size=ldapBatchSize,
+        recursive=ldapRecursive,
+        page_size=ldapPageSize,
+        pool_size=ldapPoolSize,
+        connect_timeout=ldapConnectTimeout,
+        receive_timeout=ldapReceiveTimeout,
+        start_tls=ldapStartTls,
+        validate_certificate=ldapValidateCertificate
     )
 
+    # keep request and connection traces out of the -vv output, zabbix log-level brings pyzabbix traces back
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
+    logging.getLogger('pyzabbix').setLevel(zabbixLogLevel.upper())
+
     # define Zabbix
     zabbix = Zabbix(
         url=zabbixUrl,
@@ -95,47 +121,68 @@ if __name__ == '__main__':
 
     users = {}
 
+    # the LDAP lookup does not depend on Zabbix, resolve it while the Zabbix groups are synced
+    with ThreadPoolExecutor(max_workers=1) as executor:
+
+        # resolve the ldap users of all groups at once
+        ldapGroupUsers = executor.submit(ldap.get_groups_users, [group['dn'] for group in syncGroups])
+
+        # resolve the host groups of all permissions at once
+        zabbix.get_host_groups([p['group'] for group in syncGroups for p in group.get('permissions', [])])
+
+        # create or update groups and get group ids
+        z_group_ids = zabbix.groups_update_or_create([
+            zabbix.build_user_group(
+                group['name'],
+                group.get('permissions', [])
+            )
+            for group in syncGroups
+        ])
+
+        # fetch Zabbix users after the group updates, their access flags find the users to remove
+        zabbix.get_users()
+
+        groupUsers = ldapGroupUsers.result()
+
+    # resolve the default role and all group roles at once
+    zabbix.get_role_ids([zabbixDefaultRole] + [group['role'] for group in syncGroups if 'role' in group])
+    z_default_role_id = zabbix.get_role_id(zabbixDefaultRole)
+
     # loop over configuration groups
     for group in syncGroups:
 
-        # get group id
-        z_group_id = zabbix.group_update_or_create(
-            group['name'],
-            group.get('permissions', [])
-        )
-
-        # Get ldap group members
-        members = ldap.get_group_member(group['dn'])
+        z_group_id = z_group_ids[group['name']]
 
-        for member in members:
+        # resolve group role once for all members
+        z_group_role_id = zabbix.get_role_id(group['role']) if 'role' in group else None
 
-            # get the ldap user
-            ldapUser = ldap.get_user(member)
+        # Get ldap group members
+        for ldapUser in groupUsers[group['dn']].values():
 
-            username = ldapUser['sAMAccountName']
+            username = ldapUser[ldap.attributeUsername]
 
             # if user is not in cache, add to cache
             if username not in users:
                 users[username] = {
                     'username': username,
-                    'name': ldapUser['givenName'],
-                    'surname': ldapUser['sn'],
-                    'usrgrps': [],
-                    'roleid': zabbix.get_role_id(zabbixDefaultRole)
+                    'name': ldapUser[ldap.attributeFirstName],
+                    'surname': ldapUser[ldap.attributeLastName],
+                    'usrgrps': set(),
+                    'roleid': z_default_role_id
                 }
 
             # add role to user (default if group role not present)
-            if 'role' in group:
-                users[username]['roleid'] = zabbix.get_role_id(group['role'])
+            if z_group_role_id:
+                users[username]['roleid'] = z_group_role_id
+
+            # collect group ids in a set, several ldap groups may map to one Zabbix group
+            users[username]['usrgrps'].add(z_group_id)
 
-            users[username]['usrgrps'].append({
-                'usrgrpid': z_group_id
-            })
+    for user in users.values():
+        user['usrgrps'] = [{'usrgrpid': z_group_id} for z_group_id in user['usrgrps']]
 
-    # Updating users
-    for user in users:
-        # create or update Zabbix users from LDAP
-        zabbix.user_update_or_create(users[user])
+    # create or update Zabbix users from LDAP
+    zabbix.users_update_or_create(users.values())
 
     # remove users
     # get all Zabbix users
@@ -171,7 +218,7 @@ if __name__ == '__main__':
 
     # remove groups
     z_ldap_groups = zabbix.get_ldap_user_groups()
-    configuredLdapGroupsByName = [g['name'] for g in syncGroups]
+    configuredLdapGroupsByName = {g['name'] for g in syncGroups}
 
     # check difference between Zabbix and configured LDAP groups
     delete_groups = [g['usrgrpid'] for g in z_ldap_groups if g['name'] not in configuredLdapGroupsByName]
@@ -179,4 +226,5 @@ if __name__ == '__main__':
     # delete groups
     zabbix.delete_user_group(delete_groups)
 
+    ldap.close()
     zabbix.logout()